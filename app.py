@@ -1,48 +1,1732 @@
-from shiny import App, ui, render, reactive
+import time
+from contextlib import contextmanager
+
+# How long importing and setting up the app took, shown in the About tab and
+# printed at startup so import-time regressions are easy to spot
+startup_timings = {}
+_module_started = time.perf_counter()
+
+
+@contextmanager
+def timed(name, timings=startup_timings):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = time.perf_counter() - start
+
+
+with timed("import shiny"):
+    from shiny import App, ui, render, reactive
 
 from datetime import datetime, timedelta
-import polars as pl
-import requests
+from collections import Counter, OrderedDict, defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from functools import lru_cache, partial, wraps
+from urllib.parse import parse_qs, urlparse
+
+with timed("import polars"):
+    import polars as pl
+# Labels are dictionary encoded; one shared dictionary lets frames from
+# different loads be concatenated and compared
+pl.enable_string_cache()
+with timed("import requests"):
+    import requests
+import asyncio
 import math
+import re
 import json
 import os
+import sys
 import hashlib
-
-from ollama import Client as OllamaClient
-from openai import AzureOpenAI
-from anthropic import AnthropicBedrock
+import heapq
+import inspect
+import tempfile
+import textwrap
+import zlib
+import io
+import random
+import threading
 
 from shiny.types import ImgData
 from htmltools import Tag
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Mount, Route
 
 # Default date (2 years ago)
 default_date = (datetime.now() - timedelta(days=365)).strftime("%Y-%m-%d")
 
 
-# Azure OpenAI configuration
-azure_client = AzureOpenAI(
-    api_key=os.getenv("AZURE_OPENAI_KEY"),
-    api_version="2023-05-15",
-    azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-)
+# Histogram buckets in seconds, from table renders up to full loads
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Metrics:
+    """Latency histograms of named spans, shared by every session.
+
+    Each span keeps cumulative bucket counts for the Prometheus export and
+    its most recent samples for the percentiles in the Diagnostics tab.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS, recent=1000):
+        self.buckets = buckets
+        self.recent = recent
+        self._lock = threading.Lock()
+        self._spans = {}
+
+    def observe(self, name, seconds):
+        with self._lock:
+            span = self._spans.get(name)
+            if span is None:
+                span = self._spans[name] = {
+                    "buckets": [0] * len(self.buckets),
+                    "count": 0,
+                    "sum": 0.0,
+                    "max": 0.0,
+                    "samples": deque(maxlen=self.recent),
+                }
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    span["buckets"][i] += 1
+            span["count"] += 1
+            span["sum"] += seconds
+            span["max"] = max(span["max"], seconds)
+            span["samples"].append(seconds)
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def measure(self, name):
+        """Decorator recording every call of a function as span `name`."""
+
+        def decorator(func):
+            if inspect.iscoroutinefunction(func):
+
+                @wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    with self.span(name):
+                        return await func(*args, **kwargs)
+
+                return async_wrapper
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def summary(self):
+        with self._lock:
+            spans = {
+                name: (span["count"], span["sum"], span["max"], sorted(span["samples"]))
+                for name, span in self._spans.items()
+            }
+        rows = []
+        for name, (count, total, longest, samples) in sorted(spans.items()):
+            rows.append(
+                {
+                    "Span": name,
+                    "Count": count,
+                    "Mean (ms)": round(total / count * 1000, 1),
+                    "p50 (ms)": round(samples[len(samples) // 2] * 1000, 1),
+                    "p95 (ms)": round(samples[int(len(samples) * 0.95)] * 1000, 1),
+                    "Max (ms)": round(longest * 1000, 1),
+                }
+            )
+        return pl.DataFrame(
+            rows,
+            schema={
+                "Span": pl.Utf8,
+                "Count": pl.Int64,
+                "Mean (ms)": pl.Float64,
+                "p50 (ms)": pl.Float64,
+                "p95 (ms)": pl.Float64,
+                "Max (ms)": pl.Float64,
+            },
+        )
+
+    def prometheus(self, metric="github_issues_span_seconds"):
+        """The histograms in the Prometheus text exposition format."""
+        lines = [
+            f"# HELP {metric} Duration of instrumented app spans in seconds.",
+            f"# TYPE {metric} histogram",
+        ]
+        with self._lock:
+            for name, span in sorted(self._spans.items()):
+                for bound, count in zip(self.buckets, span["buckets"]):
+                    lines.append(f'{metric}_bucket{{span="{name}",le="{bound}"}} {count}')
+                lines.append(f'{metric}_bucket{{span="{name}",le="+Inf"}} {span["count"]}')
+                lines.append(f'{metric}_sum{{span="{name}"}} {span["sum"]}')
+                lines.append(f'{metric}_count{{span="{name}"}} {span["count"]}')
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
 
-bedrock_client = AnthropicBedrock(
-    aws_profile=os.getenv("AWS_PROFILE"),
-    # aws_secret_key=os.getenv("AWS_SECRET_KEY"),
-    # aws_access_key=os.getenv("AWS_ACCESS_KEY"),
-    # aws_region=os.getenv("AWS_REGION"),
-    # aws_account_id=os.getenv("AWS_ACCOUNT_ID"),
-)
+
+async def measure_stream(stream, started, first_span, total_span):
+    """Pass `stream` through, recording the time to its first and last chunk."""
+    first = True
+    async for chunk in stream:
+        if first:
+            metrics.observe(first_span, time.perf_counter() - started)
+            first = False
+        yield chunk
+    metrics.observe(total_span, time.perf_counter() - started)
 
 
 # Add this function to generate a color based on the label text
+@lru_cache(maxsize=4096)
 def get_label_color(label):
     hash_object = hashlib.md5(label.encode())
     hex_dig = hash_object.hexdigest()
     return f"#{hex_dig[:6]}"
 
-def truncate_text(text, max_length=100):
-    return text[:max_length] + "..." if len(text) > max_length else text
+
+@lru_cache(maxsize=4096)
+def get_label_text_color(background):
+    # Black or white, whichever contrasts more with the background (WCAG
+    # relative luminance)
+    channels = [int(background[i : i + 2], 16) / 255 for i in (1, 3, 5)]
+    r, g, b = [
+        c / 12.92 if c <= 0.03928 else ((c + 0.055) / 1.055) ** 2.4 for c in channels
+    ]
+    luminance = 0.2126 * r + 0.7152 * g + 0.0722 * b
+    return "#000000" if luminance > 0.179 else "#ffffff"
+
+
+def label_palette(labels):
+    """Lookup table of background and text colors for `labels`.
+
+    Colors only depend on the label name, so they are memoized for the
+    whole process and each distinct label is hashed once.
+    """
+    colors = [get_label_color(label) for label in labels]
+    return pl.DataFrame(
+        {
+            "Label": labels,
+            "Color": colors,
+            "Text Color": [get_label_text_color(color) for color in colors],
+        },
+        schema={"Label": pl.Utf8, "Color": pl.Utf8, "Text Color": pl.Utf8},
+    )
+
+
+def build_display_frame(df, repo, max_body_length=100):
+    """Format issues for the data grids with polars expressions.
+
+    Numbers become links, labels become colored tags (one color lookup per
+    distinct label) and bodies are truncated to `max_body_length`.
+    """
+    labels = df.select(
+        "Number", pl.col("Labels").cast(pl.List(pl.Utf8)).alias("Label")
+    ).explode("Label")
+    palette = label_palette(labels.get_column("Label").unique().drop_nulls().to_list())
+    label_tags = (
+        labels.join(palette, on="Label", how="left")
+        .group_by("Number", maintain_order=True)
+        .agg(
+            pl.format(
+                '<span class="label-tag" style="background-color: {}; color: {};">{}</span>',
+                "Color",
+                "Text Color",
+                "Label",
+            )
+            .str.join("")
+            .alias("Label Tags")
+        )
+    )
+
+    body = pl.col("Body")
+    return (
+        df.join(label_tags, on="Number", how="left")
+        .with_columns(
+            pl.format(
+                '<a href="https://github.com/{}/issues/{}" target="_blank">{}</a>',
+                pl.lit(repo),
+                "Number",
+                "Number",
+            ).alias("Number"),
+            pl.col("Label Tags").alias("Labels"),
+            pl.when(body.str.len_chars() > max_body_length)
+            .then(body.str.slice(0, max_body_length) + "...")
+            .otherwise(body)
+            .alias("Body"),
+        )
+        .drop("Label Tags")
+    )
+
+
+@metrics.measure("display_records")
+def display_records(df, repo):
+    """Display frame for `df` in the form render.DataTable expects, with HTML cells."""
+    display = build_display_frame(df, repo)
+    return display.with_columns(
+        pl.Series(name, [ui.HTML(html) for html in display[name]], dtype=pl.Object)
+        for name in ("Number", "Labels")
+    )
+
+
+def label_text(column="Labels"):
+    """Expression joining a list of labels into `"bug, docs"` text."""
+    return pl.col(column).cast(pl.List(pl.Utf8)).list.join(", ")
+
+
+def page_window(df, page, page_size):
+    """Rows of `page` (1-based, clamped to the valid range) and the page count."""
+    page_count = max(math.ceil(len(df) / page_size), 1)
+    page = min(max(page or 1, 1), page_count)
+    return df.slice((page - 1) * page_size, page_size), page, page_count
+
+
+def issue_records(df):
+    """Issues of `df` in the JSON export format, one dict at a time."""
+    for row in df.iter_rows(named=True):
+        yield {
+            "number": str(row["Number"]),
+            "title": row["Title"],
+            "created_at": str(row["Created At"]),
+            "closed_at": str(row["Closed At"]),
+            "labels": row["Labels"],
+            "body": row["Body"],  # Include the issue body
+        }
+
+
+def iter_issues_json(df, repo):
+    """Yield the `{"repo": ..., "github_issues": [...]}` document issue by issue.
+
+    The concatenated chunks are identical to `json.dumps(..., indent=2)` of
+    the whole document, without ever holding it in memory.
+    """
+    yield '{\n  "repo": ' + json.dumps(repo) + ',\n  "github_issues": ['
+    separator = "\n"
+    for record in issue_records(df):
+        yield separator + textwrap.indent(json.dumps(record, indent=2), "    ")
+        separator = ",\n"
+    yield "]\n}" if separator == "\n" else "\n  ]\n}"
+
+
+@metrics.measure("format_issues_context")
+def format_issues_context(df, repo, compact=False):
+    """The issues JSON placed in the chat system prompt.
+
+    The compact form drops indentation and the dates, which do not help with
+    labeling, to save prompt tokens.
+    """
+    if not compact:
+        return "".join(iter_issues_json(df, repo))
+    issues = [
+        {
+            "number": row["Number"],
+            "title": row["Title"],
+            "labels": row["Labels"],
+            **({"body": row["Body"]} if row["Body"] else {}),
+        }
+        for row in df.iter_rows(named=True)
+    ]
+    return json.dumps(
+        {"repo": repo, "github_issues": issues},
+        separators=(",", ":"),
+        ensure_ascii=False,
+    )
+
+
+# Rough size of a prompt token, used to keep the chat context in budget
+CHARS_PER_TOKEN = 4
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+    return WORD_PATTERN.findall((text or "").lower())
+
+
+def issue_documents(df):
+    # The text both indexes search: title and body of each issue
+    return (
+        df.select(pl.concat_str(["Title", pl.col("Body").fill_null("")], separator="\n"))
+        .to_series()
+        .to_list()
+    )
+
+
+class BM25Index:
+    """Okapi BM25 ranking over the title and body of a set of issues."""
+
+    def __init__(self, numbers, documents, k1=1.5, b=0.75):
+        self.numbers = numbers
+        self.k1 = k1
+        self.b = b
+        self.postings = defaultdict(list)
+        self.lengths = []
+        for doc_id, document in enumerate(documents):
+            counts = Counter(tokenize(document))
+            self.lengths.append(sum(counts.values()))
+            for term, count in counts.items():
+                self.postings[term].append((doc_id, count))
+        self.average_length = sum(self.lengths) / len(self.lengths) if self.lengths else 1
+
+    @classmethod
+    def from_frame(cls, df):
+        return cls(df.get_column("Number").to_list(), issue_documents(df))
+
+    def search(self, query, k, exclude=()):
+        """Numbers of the `k` issues most similar to `query`, best first."""
+        scores = defaultdict(float)
+        doc_count = len(self.numbers)
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (doc_count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, count in postings:
+                length_norm = 1 - self.b + self.b * self.lengths[doc_id] / self.average_length
+                scores[doc_id] += idf * count * (self.k1 + 1) / (count + self.k1 * length_norm)
+        ranked = heapq.nlargest(k + len(exclude), scores.items(), key=lambda item: item[1])
+        numbers = [self.numbers[doc_id] for doc_id, _ in ranked]
+        return [number for number in numbers if number not in exclude][:k]
+
+
+# Search clauses: a quoted phrase or a run of non-space characters
+QUERY_PATTERN = re.compile(r'"([^"]*)"|(\S+)')
+
+
+class SearchIndex:
+    """Positional inverted index over the title and body of a set of issues.
+
+    A query is a list of clauses that must all match: a word, a prefix
+    ending in `*` (`crash*`) or a quoted phrase (`"out of memory"`).
+    Matches are row positions in the indexed frame.
+    """
+
+    def __init__(self, documents):
+        self.postings = defaultdict(dict)
+        for doc_id, document in enumerate(documents):
+            for position, term in enumerate(tokenize(document)):
+                self.postings[term].setdefault(doc_id, []).append(position)
+        self.vocabulary = sorted(self.postings)
+
+    @classmethod
+    def from_frame(cls, df):
+        return cls(issue_documents(df))
+
+    def _prefix(self, prefix):
+        docs = set()
+        for i in range(bisect_left(self.vocabulary, prefix), len(self.vocabulary)):
+            if not self.vocabulary[i].startswith(prefix):
+                break
+            docs.update(self.postings[self.vocabulary[i]])
+        return docs
+
+    def _phrase(self, terms):
+        postings = [self.postings.get(term, {}) for term in terms]
+        docs = set(postings[0]).intersection(*postings[1:])
+        if len(terms) == 1:
+            return docs
+
+        def has_phrase(doc):
+            following = [set(p[doc]) for p in postings[1:]]
+            return any(
+                all(
+                    start + offset in positions
+                    for offset, positions in enumerate(following, start=1)
+                )
+                for start in postings[0][doc]
+            )
+
+        return {doc for doc in docs if has_phrase(doc)}
+
+    def search(self, query):
+        """Rows matching every clause of `query`, or None for an empty query."""
+        matches = None
+        for phrase, word in QUERY_PATTERN.findall(query or ""):
+            terms = tokenize(phrase or word)
+            if not terms:
+                continue
+            if word.endswith("*") and len(terms) == 1:
+                docs = self._prefix(terms[0])
+            else:
+                docs = self._phrase(terms)
+            matches = docs if matches is None else matches & docs
+            if not matches:
+                break
+        return matches
+
+
+def search_issues(df, index, query=""):
+    """Issues of `df` matching `query` in its SearchIndex `index`.
+
+    The matches keep their position in `df` in a "Row" column.
+    """
+    df = df.with_row_index("Row")
+    rows = index.search(query)
+    if rows is None:
+        return df
+    return df.filter(pl.col("Row").is_in(list(rows)))
+
+
+def with_any_label(df, labels):
+    if not labels:
+        return df
+    return df.filter(
+        pl.any_horizontal(pl.col("Labels").list.contains(label) for label in labels)
+    )
+
+
+def label_facets(df):
+    """Number of issues of `df` per label, most common first."""
+    return (
+        df.select(pl.col("Labels").explode().cast(pl.Utf8).alias("Label"))
+        .drop_nulls()
+        .group_by("Label")
+        .agg(pl.len().alias("Issues"))
+        .sort(["Issues", "Label"], descending=[True, False])
+    )
+
+
+ISSUE_REFERENCE = re.compile(r"#(\d+)")
+
+
+def retrieval_query(messages):
+    """Text to find related issues for in a chat's `messages`.
+
+    Follow-up questions rarely name the issue again, so this is the latest
+    user message that references an issue (`#N`), or else every user
+    message joined.
+    """
+    user_texts = [m["content"] for m in messages if m["role"] == "user"]
+    for text in reversed(user_texts):
+        if ISSUE_REFERENCE.search(text):
+            return text
+    return "\n".join(user_texts)
+
+
+def related_issues(df, index, query, top_k, token_budget, exclude=()):
+    """The `top_k` issues of `df` most related to `query`, cut to `token_budget`.
+
+    Issues are kept in rank order while their estimated prompt size fits the
+    budget; the best match is always kept, with its body shortened if needed.
+    """
+    numbers = index.search(query, top_k, exclude)
+    ranked = (
+        pl.DataFrame(
+            {"Number": numbers, "Rank": range(len(numbers))},
+            schema={"Number": pl.Int64, "Rank": pl.Int64},
+        )
+        .join(df, on="Number")
+        .sort("Rank")
+        .drop("Rank")
+    )
+    # Title, labels and body plus room for the JSON keys around them
+    size = (
+        pl.col("Title").str.len_chars()
+        + label_text().str.len_chars()
+        + pl.col("Body").fill_null("").str.len_chars()
+        + 80
+    )
+    fits = ranked.filter((size.cum_sum() / CHARS_PER_TOKEN) <= token_budget)
+    if len(fits) == 0 and len(ranked) > 0:
+        max_body = max(token_budget * CHARS_PER_TOKEN - 80, 0)
+        fits = ranked.head(1).with_columns(pl.col("Body").str.slice(0, max_body))
+    return fits
+
+
+def iter_issues_ndjson(df, repo):
+    for record in issue_records(df):
+        yield json.dumps({"repo": repo, **record}) + "\n"
+
+
+def iter_issues_parquet(df, chunk_size=1024 * 1024):
+    # Parquet needs its footer written last, so the file is built in memory
+    # (compressed) and then sent in chunks
+    buffer = io.BytesIO()
+    df.write_parquet(buffer, compression="zstd")
+    view = buffer.getbuffer()
+    for start in range(0, len(view), chunk_size):
+        yield bytes(view[start : start + chunk_size])
+
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(wbits=31)  # gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode() if isinstance(chunk, str) else chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+EXPORT_FORMATS = {
+    "JSON": ("json", iter_issues_json),
+    "NDJSON": ("ndjson", iter_issues_ndjson),
+    "Parquet": ("parquet", lambda df, repo: iter_issues_parquet(df)),
+}
+
+
+def export_issues(df, repo, export_format="JSON", compress=False):
+    """Chunks of `df` exported as `export_format`, optionally gzip compressed."""
+    _, exporter = EXPORT_FORMATS[export_format]
+    chunks = exporter(df, repo)
+    return gzip_chunks(chunks) if compress else chunks
+
+
+def export_filename(export_format="JSON", compress=False):
+    extension, _ = EXPORT_FORMATS[export_format]
+    return f"github_issues.{extension}" + (".gz" if compress else "")
+
+
+GITHUB_API_URL = os.getenv("GITHUB_API_URL", "https://api.github.com")
+
+# Number of issue pages requested from GitHub at the same time
+MAX_FETCH_WORKERS = 8
+
+# Local cache of GitHub responses, revalidated with ETags on every load
+CACHE_DIR = os.getenv(
+    "GITHUB_ISSUES_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache"),
+)
+PAGE_CACHE_MAX_BYTES = int(os.getenv("PAGE_CACHE_MAX_MB", "200")) * 1024 * 1024
+
+
+def atomic_write(path, write):
+    """Call `write(tmp_path)`, then move the result to `path` in one step."""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    # A temporary file in the same directory, so readers never see a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    os.close(fd)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def evict_lru(directory, max_bytes):
+    """Delete the least recently used files until `directory` fits in `max_bytes`."""
+    stats = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                # Other sessions may replace or evict files while we scan
+                try:
+                    if entry.is_file():
+                        stat = entry.stat()
+                        stats.append((stat.st_mtime, stat.st_size, entry.path))
+                except OSError:
+                    pass
+    except OSError:
+        return
+    total = sum(size for _, size, _ in stats)
+    for _, size, path in sorted(stats):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+
+class PageCache:
+    """On-disk cache of GitHub API pages keyed by (repo, state, since, page URL).
+
+    Each page is stored as a one-row Parquet file holding the response body,
+    its ETag and its Link header. A file's mtime is bumped on every hit so
+    eviction can drop the least recently used pages first.
+    """
+
+    def __init__(self, directory, max_bytes=PAGE_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def _path(self, key):
+        digest = hashlib.sha256(json.dumps(key, default=str).encode()).hexdigest()
+        return os.path.join(self.directory, f"{digest}.parquet")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            entry = pl.read_parquet(path).row(0, named=True)
+            os.utime(path)
+        except (FileNotFoundError, pl.exceptions.ComputeError, OSError):
+            return None
+        return entry
+
+    def put(self, key, etag, link, body):
+        entry = pl.DataFrame({"etag": [etag], "link": [link], "body": [body]})
+        atomic_write(
+            self._path(key), partial(entry.write_parquet, compression="zstd")
+        )
+
+    def evict(self):
+        evict_lru(self.directory, self.max_bytes)
+
+
+page_cache = PageCache(os.path.join(CACHE_DIR, "pages"))
+
+
+def token_key(headers):
+    return hashlib.sha256(headers.get("Authorization", "").encode()).hexdigest()
+
+
+class RateLimitExceeded(requests.RequestException):
+    pass
+
+
+class GitHubScheduler:
+    """Per-token GitHub rate limit budgets, with retries for 429s and 5xx errors."""
+
+    RETRY_STATUSES = {500, 502, 503, 504}
+
+    def __init__(self, max_retries=4, max_wait=60, backoff=1.0):
+        self.max_retries = max_retries
+        self.max_wait = max_wait
+        self.backoff = backoff
+        self._lock = threading.Lock()
+        self._budgets = {}
+
+    @staticmethod
+    def _resource(url):
+        return "graphql" if urlparse(url).path.endswith("/graphql") else "core"
+
+    def budget(self, headers, resource="core"):
+        with self._lock:
+            budget = self._budgets.get((token_key(headers), resource))
+            return dict(budget) if budget else None
+
+    def _reserve(self, key):
+        with self._lock:
+            budget = self._budgets.get(key)
+            if budget is None:
+                return 0
+            wait = budget["reset"] - time.time()
+            if budget["remaining"] > 0 or wait <= 0:
+                budget["remaining"] -= 1
+                return 0
+        if wait > self.max_wait:
+            raise RateLimitExceeded(
+                "GitHub rate limit exhausted until "
+                + datetime.fromtimestamp(budget["reset"]).strftime("%H:%M")
+            )
+        return wait + random.uniform(0, 1)
+
+    def _record(self, key, response):
+        remaining = response.headers.get("X-RateLimit-Remaining")
+        reset = response.headers.get("X-RateLimit-Reset")
+        if remaining is None or reset is None:
+            return
+        with self._lock:
+            self._budgets[key] = {
+                "limit": int(response.headers.get("X-RateLimit-Limit", 0)),
+                "remaining": int(remaining),
+                "reset": int(reset),
+            }
+
+    def _retry_delay(self, response, attempt):
+        status = response.status_code
+        if status in (403, 429):
+            if "Retry-After" in response.headers:
+                return float(response.headers["Retry-After"])
+            if response.headers.get("X-RateLimit-Remaining") == "0":
+                reset = int(response.headers.get("X-RateLimit-Reset", 0))
+                return max(reset - time.time(), 0) + 1
+            if status == 403:
+                return None
+        elif status not in self.RETRY_STATUSES:
+            return None
+        return self.backoff * 2**attempt
+
+    def send(self, http, request):
+        key = (token_key(request.headers), self._resource(request.url))
+        for attempt in range(self.max_retries + 1):
+            wait = self._reserve(key)
+            while wait:
+                time.sleep(wait)
+                wait = self._reserve(key)
+            response = http.send(request)
+            self._record(key, response)
+            delay = self._retry_delay(response, attempt)
+            if delay is None or attempt == self.max_retries:
+                break
+            if delay > self.max_wait:
+                if response.status_code in (403, 429):
+                    raise RateLimitExceeded(
+                        f"GitHub rate limit exceeded, retry in {delay:.0f} seconds"
+                    )
+                break
+            time.sleep(delay + random.uniform(0, self.backoff))
+        return response
+
+
+github_scheduler = GitHubScheduler(max_wait=int(os.getenv("GITHUB_MAX_WAIT", "60")))
+
+
+def get_github_page(http, url, params, headers, cache=None):
+    """GET one page of a GitHub list endpoint, revalidating it against `cache`.
+
+    A cached page is sent with `If-None-Match`; a 304 answer is served from
+    disk and does not count against the rate limit. Returns the decoded
+    JSON body and the parsed Link header.
+    """
+    request = http.prepare_request(requests.Request("GET", url, params=params, headers=headers))
+    key = None
+    cached = None
+    if cache is not None:
+        # The token is part of the key so private pages are never served to
+        # a user who could not fetch them
+        key = [
+            urlparse(url).path,
+            params.get("state"),
+            params.get("since"),
+            request.url,
+            token_key(headers),
+        ]
+        cached = cache.get(key)
+        if cached and cached["etag"]:
+            request.headers["If-None-Match"] = cached["etag"]
+
+    with metrics.span("github_page_request"):
+        response = github_scheduler.send(http, request)
+    if response.status_code == 304 and cached:
+        body, link = cached["body"], cached["link"]
+    else:
+        response.raise_for_status()
+        body, link = response.text, response.headers.get("Link", "")
+        if key is not None and response.headers.get("ETag"):
+            cache.put(key, response.headers["ETag"], link, body)
+
+    links = {
+        entry.get("rel"): entry
+        for entry in requests.utils.parse_header_links(link)
+        if entry.get("rel")
+    } if link else {}
+    with metrics.span("github_json_parse"):
+        return json.loads(body), links
+
+
+def is_issue(issue):
+    return "pull_request" not in issue
+
+
+def is_labeled_issue(issue):
+    return is_issue(issue) and issue["labels"]
+
+
+def last_page_number(links):
+    last_url = links.get("last", {}).get("url")
+    if not last_url:
+        return 1
+    page = parse_qs(urlparse(last_url).query).get("page", ["1"])[0]
+    return int(page)
+
+
+def fetch_issues(
+    url, params, headers, limit, progress=None, cache=None, keep=is_labeled_issue
+):
+    """Fetch up to `limit` issues matching `keep`, paging concurrently.
+
+    Returns the matching issues and the number filtered out.
+    """
+    issues = []
+    filtered_issues = 0
+
+    def consume(page_issues):
+        nonlocal filtered_issues
+        kept_issues = [issue for issue in page_issues if keep(issue)]
+        filtered_issues += len(page_issues) - len(kept_issues)
+        if limit is None:
+            issues.extend(kept_issues)
+            return False
+        issues.extend(kept_issues[: limit - len(issues)])
+        return len(issues) >= limit
+
+    def pages_wanted(pages_done):
+        # Pages still needed at the rate of matching issues seen so far
+        if limit is None or not issues:
+            return MAX_FETCH_WORKERS
+        per_page = len(issues) / pages_done
+        return min(math.ceil((limit - len(issues)) / per_page), MAX_FETCH_WORKERS)
+
+    with requests.Session() as http:
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=MAX_FETCH_WORKERS)
+        http.mount("https://", adapter)
+        http.mount("http://", adapter)
+
+        def get_page(page):
+            page_issues, _ = get_github_page(
+                http, url, {**params, "page": page}, headers, cache
+            )
+            return page_issues
+
+        first_page, links = get_github_page(http, url, params, headers, cache)
+        total_pages = last_page_number(links)
+        done = consume(first_page)
+        if progress:
+            progress(1, total_pages)
+        if done or total_pages == 1:
+            return issues, filtered_issues
+
+        with ThreadPoolExecutor(max_workers=MAX_FETCH_WORKERS) as executor:
+            pending = {}
+            next_page = 2
+            try:
+                for page in range(2, total_pages + 1):
+                    # Queue the next pages, widening the window as pages come back short
+                    while next_page <= total_pages and len(pending) < pages_wanted(
+                        page - 1
+                    ):
+                        pending[next_page] = executor.submit(get_page, next_page)
+                        next_page += 1
+                    done = consume(pending.pop(page).result())
+                    if progress:
+                        progress(page, total_pages)
+                    if done:
+                        break
+            finally:
+                for future in pending.values():
+                    future.cancel()
+
+    return issues, filtered_issues
+
+
+# Only the fields the app uses; GraphQL issue connections never include PRs
+ISSUES_QUERY = """
+query($owner: String!, $name: String!, $since: DateTime, $states: [IssueState!], $cursor: String) {
+  repository(owner: $owner, name: $name) {
+    issues(
+      first: 100
+      after: $cursor
+      states: $states
+      filterBy: {since: $since}
+      orderBy: {field: CREATED_AT, direction: DESC}
+    ) {
+      totalCount
+      pageInfo { hasNextPage endCursor }
+      nodes {
+        number
+        title
+        body
+        state
+        createdAt
+        closedAt
+        updatedAt
+        labels(first: 100) { nodes { name } }
+      }
+    }
+  }
+}
+"""
+
+
+def graphql_issue(node):
+    # Same shape as a REST issue so the rest of the pipeline is shared
+    return {
+        "number": node["number"],
+        "title": node["title"],
+        "body": node["body"],
+        "state": node["state"].lower(),
+        "created_at": node["createdAt"],
+        "closed_at": node["closedAt"],
+        "updated_at": node["updatedAt"],
+        "labels": node["labels"]["nodes"],
+    }
+
+
+def fetch_issues_graphql(
+    owner,
+    repo_name,
+    since,
+    headers,
+    limit,
+    progress=None,
+    keep=is_labeled_issue,
+    states=("CLOSED",),
+):
+    """Fetch up to `limit` issues matching `keep` through the GraphQL API.
+
+    Pages of 100 are walked with cursors, so unlike the REST path they are
+    requested one after another. Returns the same values as `fetch_issues`.
+    """
+    since = str(since)
+    if "T" not in since:
+        since += "T00:00:00Z"
+    variables = {
+        "owner": owner,
+        "name": repo_name,
+        "since": since,
+        "states": list(states),
+        "cursor": None,
+    }
+    issues = []
+    filtered_issues = 0
+    pages_done = 0
+
+    with requests.Session() as http:
+        while True:
+            request = http.prepare_request(
+                requests.Request(
+                    "POST",
+                    f"{GITHUB_API_URL}/graphql",
+                    json={"query": ISSUES_QUERY, "variables": variables},
+                    headers=headers,
+                )
+            )
+            with metrics.span("github_graphql_request"):
+                response = github_scheduler.send(http, request)
+            response.raise_for_status()
+            with metrics.span("github_json_parse"):
+                result = response.json()
+            if result.get("errors"):
+                raise requests.RequestException(result["errors"][0]["message"])
+
+            connection = result["data"]["repository"]["issues"]
+            page_issues = [graphql_issue(node) for node in connection["nodes"]]
+            kept_issues = [issue for issue in page_issues if keep(issue)]
+            filtered_issues += len(page_issues) - len(kept_issues)
+            if limit is None:
+                issues.extend(kept_issues)
+            else:
+                issues.extend(kept_issues[: limit - len(issues)])
+
+            pages_done += 1
+            if progress:
+                total_pages = max(math.ceil(connection["totalCount"] / 100), pages_done)
+                progress(pages_done, total_pages)
+
+            if limit is not None and len(issues) >= limit:
+                break
+            if not connection["pageInfo"]["hasNextPage"]:
+                break
+            variables["cursor"] = connection["pageInfo"]["endCursor"]
+
+    return issues, filtered_issues
+
+
+def fetch_repo_issues(
+    owner,
+    repo_name,
+    since,
+    headers,
+    limit,
+    backend="REST",
+    progress=None,
+    updates_only=False,
+):
+    """Fetch issues of `owner/repo_name` with the chosen API backend.
+
+    A normal load returns closed, labeled issues. With `updates_only` every
+    issue changed since `since` is returned, open or closed, so the caller
+    can merge it into an earlier load.
+    """
+    keep = is_issue if updates_only else is_labeled_issue
+    if backend == "GraphQL":
+        states = ("OPEN", "CLOSED") if updates_only else ("CLOSED",)
+        return fetch_issues_graphql(
+            owner, repo_name, since, headers, limit, progress, keep, states
+        )
+
+    url = f"{GITHUB_API_URL}/repos/{owner}/{repo_name}/issues"
+    params = {
+        "state": "all" if updates_only else "closed",
+        "since": since,
+        "per_page": 100,
+    }
+    try:
+        return fetch_issues(url, params, headers, limit, progress, page_cache, keep)
+    finally:
+        page_cache.evict()
+
+
+ISSUE_SCHEMA = {
+    "Number": pl.Int64,
+    "Title": pl.Utf8,
+    "Created At": pl.Date,
+    "Closed At": pl.Date,
+    "Labels": pl.List(pl.Categorical),
+    "Body": pl.Utf8,
+}
+
+GITHUB_TIMESTAMP = "%Y-%m-%dT%H:%M:%SZ"
+
+
+@metrics.measure("issues_to_frame")
+def issues_to_frame(issues):
+    """Typed issues frame, built column by column from the API's issue dicts."""
+    columns = {
+        "Number": [issue["number"] for issue in issues],
+        "Title": [issue["title"] for issue in issues],
+        "Created At": [issue["created_at"] for issue in issues],
+        "Closed At": [issue["closed_at"] for issue in issues],
+        "Labels": [[label["name"] for label in issue["labels"]] for issue in issues],
+        "Body": [issue["body"] for issue in issues],
+    }
+    # Timestamps arrive as text and are parsed straight into dates
+    schema = {**ISSUE_SCHEMA, "Created At": pl.Utf8, "Closed At": pl.Utf8}
+    return pl.DataFrame(columns, schema=schema).with_columns(
+        pl.col("Created At", "Closed At").str.strptime(pl.Date, GITHUB_TIMESTAMP)
+    )
+
+
+def latest_update(issues, default=None):
+    return max((issue["updated_at"] for issue in issues), default=default)
+
+
+def merge_issue_updates(df, updates):
+    """Upsert issues changed since the last sync into `df` by `Number`.
+
+    Updated issues replace their old rows; issues that were reopened or lost
+    all their labels are dropped. Rows stay newest first, like the REST API.
+    """
+    changed = [issue["number"] for issue in updates]
+    current = [
+        issue for issue in updates if issue["state"] == "closed" and issue["labels"]
+    ]
+    df = df.filter(~pl.col("Number").is_in(changed))
+    if current:
+        df = pl.concat([issues_to_frame(current), df])
+    return df.sort("Number", descending=True)
+
+
+def github_headers(token=None):
+    headers = {"Accept": "application/vnd.github.v3+json"}
+    if token:
+        headers["Authorization"] = f"token {token}"
+    return headers
+
+
+def load_repo_entry(
+    repo, cutoff, num_issues, headers, backend="REST", previous=None, progress=None
+):
+    """Fetch an issue store entry for `repo`.
+
+    With a `previous` entry only the issues updated since it was fetched are
+    requested and merged into it.
+    """
+    owner, repo_name = repo.split("/")
+    if previous and previous["updated_at"]:
+        # Only ask for what changed, including reopened issues
+        updates, _ = fetch_repo_issues(
+            owner,
+            repo_name,
+            previous["updated_at"],
+            headers,
+            None,
+            backend=backend,
+            progress=progress,
+            updates_only=True,
+        )
+        if not updates:
+            # Nothing changed, so sessions keep sharing the same frame
+            return previous
+        df = merge_issue_updates(previous["df"], updates)
+        return {
+            "df": df.head(num_issues),
+            "filtered": previous["filtered"],
+            "updated_at": latest_update(updates, default=previous["updated_at"]),
+        }
+
+    issues, filtered_issues = fetch_repo_issues(
+        owner,
+        repo_name,
+        cutoff,
+        headers,
+        num_issues,
+        backend=backend,
+        progress=progress,
+    )
+    return {
+        "df": issues_to_frame(issues),
+        "filtered": filtered_issues,
+        "updated_at": latest_update(issues),
+    }
+
+
+ISSUE_STORE_MAX_BYTES = int(os.getenv("ISSUE_STORE_MAX_MB", "512")) * 1024 * 1024
+
+
+class IssueStore:
+    """Loaded issues shared by sessions using the same token, evicted LRU."""
+
+    def __init__(self, max_bytes=ISSUE_STORE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._loading = {}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            total = sum(e["df"].estimated_size() for e in self._entries.values())
+            # Never evict the entry that was just stored
+            while total > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                total -= evicted["df"].estimated_size()
+
+    def load(self, key, loader):
+        """Store and return `loader()`, or join a load of `key` already in flight."""
+        with self._lock:
+            future = self._loading.get(key)
+            owner = future is None
+            if owner:
+                future = self._loading[key] = Future()
+        if not owner:
+            return future.result()
+
+        try:
+            entry = loader()
+            self.put(key, entry)
+            future.set_result(entry)
+            return entry
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._loading[key]
+
+
+issue_store = IssueStore()
+
+
+ISSUE_ARCHIVE_DIR = os.getenv("ISSUE_ARCHIVE_DIR", os.path.join(CACHE_DIR, "archive"))
+
+
+def archive_frame(repo, df):
+    """Issues of `repo` as archived, with labels stored as plain strings."""
+    return df.select(
+        pl.lit(repo).alias("Repo"),
+        "Number",
+        "Title",
+        "Created At",
+        "Closed At",
+        pl.col("Labels").cast(pl.List(pl.Utf8)),
+        "Body",
+    )
+
+
+class IssueArchive:
+    """Fetched issues per token, as Parquet partitioned by repo and created month."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+
+    def _token_dir(self, headers):
+        return os.path.join(self.directory, "token=" + token_key(headers)[:16])
+
+    def _repo_dir(self, headers, repo):
+        return os.path.join(self._token_dir(headers), "repo=" + repo.replace("/", "__"))
+
+    def repos(self, headers):
+        try:
+            names = sorted(os.listdir(self._token_dir(headers)))
+        except OSError:
+            return []
+        return [
+            name.removeprefix("repo=").replace("__", "/")
+            for name in names
+            if name.startswith("repo=")
+        ]
+
+    def write(self, headers, repo, df):
+        """Upsert the issues of `repo` in `df` into their month partitions."""
+        frame = archive_frame(repo, df).with_columns(
+            pl.col("Created At").dt.strftime("%Y-%m").alias("Month")
+        )
+        with self._lock:
+            for (month,), part in frame.group_by("Month"):
+                part_dir = os.path.join(self._repo_dir(headers, repo), f"month={month}")
+                path = os.path.join(part_dir, "issues.parquet")
+                part = part.drop("Month")
+                if os.path.exists(path):
+                    existing = pl.read_parquet(path)
+                    part = pl.concat(
+                        [part, existing.filter(~pl.col("Number").is_in(part["Number"]))]
+                    )
+                atomic_write(
+                    path,
+                    partial(
+                        part.sort("Number", descending=True).write_parquet,
+                        compression="zstd",
+                    ),
+                )
+
+    def _paths(self, headers, repos=None, start=None, end=None):
+        paths = []
+        for repo in repos or self.repos(headers):
+            repo_dir = self._repo_dir(headers, repo)
+            if not os.path.isdir(repo_dir):
+                continue
+            for name in sorted(os.listdir(repo_dir)):
+                month = name.removeprefix("month=")
+                # Skip partitions outside the date range without opening them
+                if start and month < start.strftime("%Y-%m"):
+                    continue
+                if end and month > end.strftime("%Y-%m"):
+                    continue
+                path = os.path.join(repo_dir, name, "issues.parquet")
+                if os.path.exists(path):
+                    paths.append(path)
+        return paths
+
+    def scan(self, headers, repos=None, start=None, end=None, labels=None):
+        """Lazy frame of archived issues matching the filters, or None if there are none.
+
+        Only the archive of the token in `headers` is read. `start`/`end`
+        bound the creation date; `labels` keeps issues having any of the
+        given labels.
+        """
+        paths = self._paths(headers, repos, start, end)
+        if not paths:
+            return None
+        lf = pl.scan_parquet(paths, hive_partitioning=False)
+        if start:
+            lf = lf.filter(pl.col("Created At") >= start)
+        if end:
+            lf = lf.filter(pl.col("Created At") <= end)
+        if labels:
+            lf = lf.filter(
+                pl.any_horizontal([pl.col("Labels").list.contains(label) for label in labels])
+            )
+        return lf
+
+
+issue_archive = IssueArchive(ISSUE_ARCHIVE_DIR)
+
+
+WATCHED_REPOS = [
+    repo.strip() for repo in os.getenv("WATCHED_REPOS", "").split(",") if repo.strip()
+]
+WATCH_INTERVAL = float(os.getenv("WATCH_INTERVAL_MINUTES", "15")) * 60
+WATCH_NUM_ISSUES = int(os.getenv("WATCH_NUM_ISSUES", "100"))
+
+
+class IssuePrefetcher:
+    """Refreshes watched repositories into `issue_store` on a background thread.
+
+    Entries use the store key of a load with the default cutoff date and
+    the `GITHUB_TOKEN` token, so "Load Issues" with the default settings
+    finds them ready. After the
+    first fetch each refresh only asks for issues updated since the last
+    one, and unchanged pages are answered from the page cache by ETag.
+    """
+
+    def __init__(self, repos, interval, num_issues, token=None, store=issue_store):
+        self.repos = repos
+        self.interval = interval
+        self.num_issues = num_issues
+        self.headers = github_headers(token)
+        self.store = store
+        self._lock = threading.Lock()
+        self._status = {}
+        self._wake = threading.Event()
+        self._force = False
+        self._thread = None
+
+    def store_key(self, repo):
+        return (repo, default_date, self.num_issues, token_key(self.headers))
+
+    def start(self):
+        if self.repos and self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="issue-prefetcher", daemon=True
+            )
+            self._thread.start()
+
+    def refresh_now(self, force=False):
+        """Wake the thread to refresh every repository; `force` refetches from scratch."""
+        self._force = self._force or force
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            force, self._force = self._force, False
+            for repo in self.repos:
+                self.refresh(repo, force)
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def refresh(self, repo, force=False):
+        key = self.store_key(repo)
+
+        def loader():
+            previous = None if force else self.store.get(key)
+            return load_repo_entry(
+                repo, default_date, self.num_issues, self.headers, previous=previous
+            )
+
+        started = time.perf_counter()
+        try:
+            if repo.count("/") != 1:
+                raise ValueError("Invalid repository format. Use 'username/repo'")
+            entry = self.store.load(key, loader)
+            status = {"issues": entry["df"].height, "error": None}
+        except Exception as e:
+            # Any failure is reported for this repository; the thread and the
+            # other repositories carry on
+            status = {"issues": None, "error": f"{type(e).__name__}: {e}"}
+        status["refreshed_at"] = datetime.now()
+        status["duration"] = time.perf_counter() - started
+        with self._lock:
+            self._status[repo] = status
+
+    def is_fresh(self, key):
+        """Whether `key` belongs to a watched repository refreshed within two intervals."""
+        if key[0] not in self.repos or key != self.store_key(key[0]):
+            return False
+        with self._lock:
+            status = self._status.get(key[0])
+        return (
+            status is not None
+            and status["error"] is None
+            and (datetime.now() - status["refreshed_at"]).total_seconds()
+            < 2 * self.interval
+        )
+
+    def status(self):
+        with self._lock:
+            statuses = dict(self._status)
+        rows = []
+        for repo in self.repos:
+            status = statuses.get(repo)
+            rows.append(
+                {
+                    "Repository": repo,
+                    "Last Refresh": status["refreshed_at"].strftime("%Y-%m-%d %H:%M:%S")
+                    if status
+                    else "pending",
+                    "Duration (s)": round(status["duration"], 2) if status else None,
+                    "Issues": status["issues"] if status else None,
+                    "Status": (status["error"] or "ok") if status else "pending",
+                }
+            )
+        return pl.DataFrame(
+            rows,
+            schema={
+                "Repository": pl.Utf8,
+                "Last Refresh": pl.Utf8,
+                "Duration (s)": pl.Float64,
+                "Issues": pl.Int64,
+                "Status": pl.Utf8,
+            },
+        )
+
+
+issue_prefetcher = IssuePrefetcher(
+    WATCHED_REPOS, WATCH_INTERVAL, WATCH_NUM_ISSUES, token=os.getenv("GITHUB_TOKEN")
+)
+
+
+LABEL_INSTRUCTIONS = (
+    "Reply with only the labels that should be applied, separated by commas."
+)
+
+
+def label_prompt(issue):
+    return (
+        "Analyze this issue to determin which issue labels should be applied "
+        f"#{issue['Number']}: {issue['Title']}\n\nBody: {issue['Body']}\n\n"
+        + LABEL_INSTRUCTIONS
+    )
+
+
+def parse_labels(text, known_labels):
+    """Labels from `known_labels` named in a comma separated model answer."""
+    by_name = {label.lower(): label for label in known_labels}
+    names = (name.strip(" `*-\"'.").lower() for name in re.split(r"[,\n]", text))
+    return {by_name[name] for name in names if name in by_name}
+
+
+def label_scores(predicted, actual):
+    """Micro-averaged precision and recall of predicted label sets."""
+    true_positives = sum(len(p & a) for p, a in zip(predicted, actual))
+    predicted_count = sum(len(p) for p in predicted)
+    actual_count = sum(len(a) for a in actual)
+    precision = true_positives / predicted_count if predicted_count else 0.0
+    recall = true_positives / actual_count if actual_count else 0.0
+    return precision, recall
+
+
+def with_system_message(messages, system):
+    messages = list(messages)
+    if messages and messages[0]["role"] == "system":
+        messages[0] = {**messages[0], "content": system}
+    else:
+        messages.insert(0, {"role": "system", "content": system})
+    return messages
+
+
+class ChatProvider(ABC):
+    """A chat model backend with an async client.
+
+    `message_format` is the `chat.messages()` format the backend accepts;
+    `model` and `endpoint` identify where answers come from. `stream()`
+    yields the answer as text chunks and `complete()` returns it in one
+    piece.
+    """
+
+    message_format = None
+    model = None
+    endpoint = None
+
+    @abstractmethod
+    def stream(self, system, messages):
+        pass
+
+    @abstractmethod
+    async def complete(self, system, prompt):
+        pass
+
+
+class AzureOpenAIProvider(ChatProvider):
+    message_format = "openai"
+    model = "gpt-4o"
+
+    def __init__(self):
+        self.endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
+        # Azure OpenAI configuration
+        # Provider SDKs are imported on first use to keep app startup fast
+        with timed("import openai (first use)"):
+            from openai import AsyncAzureOpenAI
+        self.client = AsyncAzureOpenAI(
+            api_key=os.getenv("AZURE_OPENAI_KEY"),
+            api_version="2023-05-15",
+            azure_endpoint=self.endpoint,
+        )
+
+    async def stream(self, system, messages):
+        response = await self.client.chat.completions.create(
+            model=self.model,
+            messages=with_system_message(messages, system),
+            stream=True,
+        )
+        async for chunk in response:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    async def complete(self, system, prompt):
+        response = await self.client.chat.completions.create(
+            model=self.model,
+            messages=with_system_message([{"role": "user", "content": prompt}], system),
+        )
+        return response.choices[0].message.content
+
+
+class OllamaProvider(ChatProvider):
+    message_format = "ollama"
+
+    def __init__(self, endpoint, model):
+        with timed("import ollama (first use)"):
+            from ollama import AsyncClient
+        self.client = AsyncClient(host=endpoint)
+        self.endpoint = endpoint
+        self.model = model
+
+    async def stream(self, system, messages):
+        response = await self.client.chat(
+            model=self.model,
+            messages=with_system_message(messages, system),
+            stream=True,
+        )
+        async for chunk in response:
+            if chunk["message"]["content"]:
+                yield chunk["message"]["content"]
+
+    async def complete(self, system, prompt):
+        response = await self.client.chat(
+            model=self.model,
+            messages=with_system_message([{"role": "user", "content": prompt}], system),
+        )
+        return response["message"]["content"]
+
+
+class BedrockProvider(ChatProvider):
+    # Claude 3.5 Sonnet via Bedrock; the system prompt is a separate argument
+    message_format = "anthropic"
+    model = "anthropic.claude-3-5-sonnet-20240620-v1:0"
+
+    def __init__(self):
+        self.endpoint = f"bedrock:{os.getenv('AWS_PROFILE')}"
+        with timed("import anthropic (first use)"):
+            from anthropic import AsyncAnthropicBedrock
+        self.client = AsyncAnthropicBedrock(
+            aws_profile=os.getenv("AWS_PROFILE"),
+            # aws_secret_key=os.getenv("AWS_SECRET_KEY"),
+            # aws_access_key=os.getenv("AWS_ACCESS_KEY"),
+            # aws_region=os.getenv("AWS_REGION"),
+            # aws_account_id=os.getenv("AWS_ACCOUNT_ID"),
+        )
+
+    async def stream(self, system, messages):
+        response = await self.client.messages.create(
+            model=self.model,
+            messages=list(messages),
+            stream=True,
+            system=system,
+            max_tokens=1000,
+        )
+        async for event in response:
+            if event.type == "content_block_delta" and event.delta.type == "text_delta":
+                yield event.delta.text
+
+    async def complete(self, system, prompt):
+        response = await self.client.messages.create(
+            model=self.model,
+            messages=[{"role": "user", "content": prompt}],
+            system=system,
+            max_tokens=1000,
+        )
+        return response.content[0].text
+
+
+@lru_cache(maxsize=32)
+def get_chat_provider(chat_model, ollama_endpoint=None, ollama_model=None):
+    """Chat provider for the selected model, shared by every session.
+
+    Clients are built the first time a backend (or Ollama endpoint and model)
+    is chosen and then reused, keeping their connection pools warm.
+    """
+    if chat_model == "AzureOpenAI":
+        return AzureOpenAIProvider()
+    elif chat_model == "Ollama":
+        return OllamaProvider(ollama_endpoint, ollama_model)
+    else:
+        return BedrockProvider()
+
+
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL_HOURS", "24")) * 3600
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_MB", "50")) * 1024 * 1024
+# Seconds between scans of the response cache for eviction
+RESPONSE_CACHE_EVICT_INTERVAL = 60
+
+
+class ResponseCache:
+    """Completed model answers on disk, addressed by what was asked.
+
+    Keys hash the model, endpoint, formatted system prompt and messages.
+    Entries expire after `ttl` seconds and the least recently used are
+    evicted once the directory grows past `max_bytes`, checked at most every
+    RESPONSE_CACHE_EVICT_INTERVAL seconds. Reads and writes block, so call
+    them off the event loop.
+    """
+
+    def __init__(self, directory, ttl=RESPONSE_CACHE_TTL, max_bytes=RESPONSE_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.last_evicted = 0.0
+
+    @staticmethod
+    def key(provider, system, messages):
+        system_hash = hashlib.sha256(system.encode()).hexdigest()
+        request = [provider.model, provider.endpoint, system_hash, list(messages)]
+        return hashlib.sha256(
+            json.dumps(request, sort_keys=True, default=str).encode()
+        ).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8") as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if time.time() - entry["created"] > self.ttl:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            return None
+        os.utime(path)
+        return entry["answer"]
+
+    def put(self, key, answer):
+        def write(tmp_path):
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"created": time.time(), "answer": answer}, f)
+
+        atomic_write(self._path(key), write)
+        if time.monotonic() - self.last_evicted > RESPONSE_CACHE_EVICT_INTERVAL:
+            self.evict()
+
+    def evict(self):
+        self.last_evicted = time.monotonic()
+        evict_lru(self.directory, self.max_bytes)
+
+
+response_cache = ResponseCache(os.path.join(CACHE_DIR, "responses"))
+
+
+async def replay_answer(answer, chunk_size=200):
+    # A cached answer goes through the same streaming path as a live one
+    for start in range(0, len(answer), chunk_size):
+        yield answer[start : start + chunk_size]
+
+
+async def cache_answer(cache, key, stream):
+    """Pass `stream` through and store the full answer once it completes."""
+    chunks = []
+    async for chunk in stream:
+        chunks.append(chunk)
+        yield chunk
+    await asyncio.to_thread(cache.put, key, "".join(chunks))
+
+
+async def label_issues(jobs, complete, concurrency=4, cache=None, on_done=None):
+    """Answer every (system, prompt) job with `complete`, at most `concurrency` at once.
+
+    `complete(system, prompt)` is a coroutine function. Identical jobs are
+    sent once, and answers already in `cache` (a dict keyed by job) are not
+    sent at all. `on_done()` is called as each job finishes. Returns the
+    answers in job order.
+    """
+    cache = {} if cache is None else cache
+    semaphore = asyncio.Semaphore(concurrency)
+    in_flight = {}
+
+    async def ask(job):
+        async with semaphore:
+            answer = await complete(*job)
+        cache[job] = answer
+        return answer
+
+    async def answer(job):
+        if job in cache:
+            result = cache[job]
+        else:
+            if job not in in_flight:
+                in_flight[job] = asyncio.ensure_future(ask(job))
+            result = await in_flight[job]
+        if on_done:
+            on_done()
+        return result
+
+    return await asyncio.gather(*(answer(job) for job in jobs))
 
 
 app_ui = ui.page_fluid(
@@ -109,20 +1793,80 @@ app_ui = ui.page_fluid(
                         "num_issues",
                         "Number of Issues",
                         min=10,
-                        max=500,
+                        max=10000,
                         value=100,
                         step=10,
                     ),
+                    ui.input_radio_buttons(
+                        "api_backend",
+                        "GitHub API",
+                        choices=["REST", "GraphQL"],
+                        selected="REST",
+                        inline=True,
+                    ),
+                    ui.input_checkbox(
+                        "incremental_sync",
+                        "Only fetch issues updated since the last load",
+                        value=True,
+                    ),
+                    ui.input_checkbox(
+                        "archive_issues", "Save loaded issues to the local archive", value=True
+                    ),
                     ui.input_action_button("load_issues", "Load Issues"),
                     ui.output_text("filtered_count_text"),
+                    ui.output_text("rate_limit_text"),
                     # ui.output_text("selected_issue"),
-                    ui.download_button("download_json", "Download Main Table as JSON"),
+                    ui.input_select(
+                        "export_format",
+                        "Download format",
+                        choices=list(EXPORT_FORMATS),
+                        selected="JSON",
+                    ),
+                    ui.input_checkbox("export_gzip", "Compress with gzip", value=False),
+                    ui.download_button("download_json", "Download Main Table"),
                     open="open",
                 ),
                 ui.div(
+                    ui.div(
+                        ui.input_text(
+                            "table_filter",
+                            "Search title and body",
+                            placeholder='crash*, "out of memory"',
+                        ),
+                        ui.input_selectize(
+                            "table_labels",
+                            "Labels (any)",
+                            choices=[],
+                            multiple=True,
+                        ),
+                        ui.input_select(
+                            "table_sort",
+                            "Sort by",
+                            choices=["Number", "Title", "Created At", "Closed At"],
+                            selected="Number",
+                        ),
+                        ui.input_checkbox("table_sort_desc", "Descending", value=True),
+                        ui.input_select(
+                            "table_page_size",
+                            "Rows per page",
+                            choices=["25", "50", "100", "200"],
+                            selected="50",
+                        ),
+                        class_="d-flex gap-3 align-items-end",
+                    ),
                     ui.h3("80% of Issues"),
+                    ui.div(
+                        ui.input_numeric("main_page", "Page", value=1, min=1),
+                        ui.output_text("main_page_info"),
+                        class_="d-flex gap-3 align-items-center",
+                    ),
                     ui.output_data_frame("issues_table_main"),
                     ui.h3("Remaining 20% of Issues"),
+                    ui.div(
+                        ui.input_numeric("secondary_page", "Page", value=1, min=1),
+                        ui.output_text("secondary_page_info"),
+                        class_="d-flex gap-3 align-items-center",
+                    ),
                     ui.output_data_frame("issues_table_secondary"),
                     class_="w-100",
                 ),
@@ -163,6 +1907,29 @@ app_ui = ui.page_fluid(
                         "analyze_issue", "What issue do you want to analyze?"
                     ),
                     ui.input_action_button("load_issue_query", "Create Issue Query"),
+                    ui.input_numeric(
+                        "context_top_k",
+                        "Related issues in context (0 = all)",
+                        value=20,
+                        min=0,
+                    ),
+                    ui.input_numeric(
+                        "context_token_budget",
+                        "Context token budget",
+                        value=4000,
+                        min=500,
+                        step=500,
+                    ),
+                    ui.input_checkbox(
+                        "use_response_cache",
+                        "Reuse cached answers for identical questions",
+                        value=True,
+                    ),
+                    ui.input_checkbox(
+                        "compact_context",
+                        "Compact issue context (fewer prompt tokens)",
+                        value=False,
+                    ),
                     ui.input_action_button(
                         "reset_chat", "Reset chat", class_="btn-warning"
                     ),
@@ -187,6 +1954,93 @@ related issues to decide how to label the current issue:
                 ),
             ),
         ),
+        ui.nav_panel(
+            "Watched Repositories",
+            ui.layout_sidebar(
+                ui.sidebar(
+                    ui.p(
+                        "Repositories listed in WATCHED_REPOS are refreshed in the "
+                        "background, so loading them with the default cutoff date "
+                        "and number of issues returns immediately."
+                    ),
+                    ui.input_action_button("refresh_watched", "Refresh Now"),
+                    ui.input_action_button("refetch_watched", "Refetch From Scratch"),
+                    open="open",
+                ),
+                ui.div(
+                    ui.output_data_frame("watch_status"),
+                    class_="w-100",
+                ),
+            ),
+        ),
+        ui.nav_panel(
+            "Archive",
+            ui.layout_sidebar(
+                ui.sidebar(
+                    ui.input_text(
+                        "archive_repos",
+                        "Repositories",
+                        placeholder="owner/repo, ... (all when empty)",
+                    ),
+                    ui.input_date_range(
+                        "archive_dates", "Created between", start=default_date
+                    ),
+                    ui.input_text(
+                        "archive_labels", "Labels", placeholder="bug, docs (any)"
+                    ),
+                    ui.input_action_button("query_archive", "Query Archive"),
+                    ui.output_text("archive_repos_text"),
+                    open="open",
+                ),
+                ui.div(
+                    ui.h3("Issues per Repository and Label"),
+                    ui.output_data_frame("archive_summary"),
+                    ui.h3("Matching Issues"),
+                    ui.output_text("archive_count_text"),
+                    ui.output_data_frame("archive_results"),
+                    class_="w-100",
+                ),
+            ),
+        ),
+        ui.nav_panel(
+            "Batch Labeling",
+            ui.layout_sidebar(
+                ui.sidebar(
+                    ui.p(
+                        "Label every issue of the 20% table with the chat model "
+                        "and system prompt selected on the Chat tab."
+                    ),
+                    ui.input_numeric(
+                        "batch_concurrency",
+                        "Parallel model calls",
+                        value=4,
+                        min=1,
+                        max=32,
+                    ),
+                    ui.input_action_button(
+                        "run_batch_labeling", "Label Remaining 20%"
+                    ),
+                    open="open",
+                ),
+                ui.div(
+                    ui.output_text("batch_summary"),
+                    ui.output_data_frame("batch_results_table"),
+                    class_="w-100",
+                ),
+            ),
+        ),
+        ui.nav_panel(
+            "Diagnostics",
+            ui.div(
+                ui.p(
+                    "Latency of instrumented spans since the app started. Percentiles "
+                    "cover the most recent 1000 samples of each span. The histograms "
+                    "are also served in the Prometheus text format at /metrics."
+                ),
+                ui.output_data_frame("diagnostics"),
+                class_="w-100",
+            ),
+        ),
         ui.nav_panel(
             "About",
             ui.layout_sidebar(
@@ -224,6 +2078,8 @@ related issues to decide how to label the current issue:
                     ui.p(
                         "For more information or to report issues, please visit our GitHub repository."
                     ),
+                    ui.h4("Startup Timings"),
+                    ui.output_text_verbatim("startup_report"),
                     class_="w-100",
                 ),
             ),
@@ -234,6 +2090,9 @@ related issues to decide how to label the current issue:
 
 def server(input, output, session):
     issues_data = reactive.Value(None)
+    # Repository the loaded issues belong to, so editing the repo box does
+    # not rebuild the tables
+    loaded_repo = reactive.Value(None)
     filtered_count = reactive.Value(0)
     test_data = reactive.Value({ "issues": { "1": "Issue 1"}})
 
@@ -259,17 +2118,39 @@ def server(input, output, session):
     async def reset():
         # print("Resetting chat")
         await chat.clear_messages()
+        last_chat_context.set(None)
+
+    # Context of the previous chat turn, reused when a follow-up matches nothing
+    last_chat_context = reactive.Value(None)
+
+    @reactive.effect
+    @reactive.event(issues_data)
+    def forget_chat_context():
+        last_chat_context.set(None)
+
+    @reactive.calc
+    def issue_rows():
+        # Row of every issue number, built once per load for single-issue lookups
+        if issues_data() is None:
+            return None
+        return dict(zip(issues_data().get_column("Number"), range(issues_data().height)))
+
+    def find_issue(number):
+        """The loaded issue `number` as a dict, or None."""
+        rows = issue_rows()
+        if rows is None or number not in rows:
+            return None
+        return issues_data().row(rows[number], named=True)
 
     @reactive.effect
     @reactive.event(input.load_issue_query)
     def load():
         issue_number = input.analyze_issue()
         if issues_data() is not None and issue_number:
-            df = issues_data()
-            issue = df.filter(pl.col("Number") == int(issue_number))
-            if issue.height > 0:
-                title = issue.select("Title").item()
-                body = issue.select("Body").item()
+            issue = find_issue(int(issue_number))
+            if issue is not None:
+                title = issue["Title"]
+                body = issue["Body"]
                 text = f"Analyze this issue to determin which issue labels should be applied #{issue_number}: {title}\n\nBody: {body}"
             else:
                 text = f"Issue #{issue_number} not found in the loaded data."
@@ -280,7 +2161,8 @@ def server(input, output, session):
 
     @reactive.Effect
     @reactive.event(input.load_issues)
-    def load_issues():
+    @metrics.measure("load_issues")
+    async def load_issues():
         repo = input.repo()
         cutoff_date = input.cutoff()
         num_issues = input.num_issues()
@@ -299,11 +2181,29 @@ def server(input, output, session):
 
         # Get the GitHub token from environment variable
         github_token = input.github_token()
+        backend = input.api_backend()
+        archive_enabled = input.archive_issues()
 
-        headers = {"Accept": "application/vnd.github.v3+json"}
+        if backend == "GraphQL" and not github_token:
+            ui.notification_show(
+                "The GraphQL API requires a GitHub PAT", type="error"
+            )
+            return
+
+        headers = github_headers(github_token)
+        # Loads are only shared between sessions using the same token
+        store_key = (repo, str(cutoff_date), num_issues, token_key(headers))
+
+        if issue_prefetcher.is_fresh(store_key):
+            # Kept up to date in the background, so no fetch is needed
+            entry = issue_store.get(store_key)
+            if entry is not None:
+                loaded_repo.set(repo)
+                issues_data.set(entry["df"])
+                filtered_count.set(entry["filtered"])
+                return
 
         if github_token:
-            headers["Authorization"] = f"token {github_token}"
             ui.notification_show(
                 "Using authenticated GitHub API requests", type="message"
             )
@@ -317,63 +2217,49 @@ def server(input, output, session):
             p.set(message="Fetching issues...", detail="This may take a moment.")
 
             try:
-                url = f"https://api.github.com/repos/{owner}/{repo_name}/issues"
-                params = {"state": "closed", "since": cutoff_date, "per_page": 100}
-                issues = []
-                total_issues = 0
-                filtered_issues = 0
-
-                while url and len(issues) < num_issues:
-                    response = requests.get(url, params=params, headers=headers)
-                    response.raise_for_status()
-                    new_issues = response.json()
-                    total_issues += len(new_issues)
-                    labeled_issues = [
-                        issue
-                        for issue in new_issues
-                        if "pull_request" not in issue and issue["labels"]
-                    ]
-                    filtered_issues += len(new_issues) - len(labeled_issues)
-                    issues.extend(labeled_issues[: num_issues - len(issues)])
-                    if len(issues) >= num_issues:
-                        break
-                    url = response.links.get("next", {}).get("url")
-                    params = {}  # Clear params for subsequent requests
-
-                p.set(50, message="Processing data...")
-
-                data = [
-                    {
-                        "Number": issue["number"],
-                        "Title": issue["title"],
-                        "Created At": issue["created_at"],
-                        "Closed At": issue["closed_at"],
-                        "Labels": ", ".join(
-                            [label["name"] for label in issue["labels"]]
-                        ),
-                        "Body": issue["body"],
-                    }
-                    for issue in issues
-                ]
-
-                df = pl.DataFrame(data)
-                df = df.with_columns(
-                    [
-                        pl.col("Created At")
-                        .str.strptime(pl.Date, "%Y-%m-%dT%H:%M:%SZ")
-                        .dt.date()
-                        .cast(pl.Utf8)
-                        ,#.str.strftime("%Y-%m-%d"),
-                        pl.col("Closed At")
-                        .str.strptime(pl.Date, "%Y-%m-%dT%H:%M:%SZ")
-                        .dt.date()
-                        .cast(pl.Utf8)
-                        ,#.str.strftime("%Y-%m-%d"),
-                    ]
-                )
-
-                issues_data.set(df)
-                filtered_count.set(filtered_issues)
+                incremental = input.incremental_sync()
+                loop = asyncio.get_running_loop()
+
+                def report_progress(pages_done, total_pages):
+                    # Called from the fetch thread
+                    loop.call_soon_threadsafe(
+                        partial(
+                            p.set,
+                            50 * pages_done / total_pages,
+                            message="Fetching issues...",
+                            detail=f"Page {pages_done} of {total_pages}",
+                        )
+                    )
+
+                def load_entry():
+                    return load_repo_entry(
+                        repo,
+                        cutoff_date,
+                        num_issues,
+                        headers,
+                        backend=backend,
+                        previous=issue_store.get(store_key) if incremental else None,
+                        progress=report_progress,
+                    )
+
+                # Fetch off the event loop so other sessions stay responsive
+                entry = await asyncio.to_thread(issue_store.load, store_key, load_entry)
+
+                loaded_repo.set(repo)
+                issues_data.set(entry["df"])
+                filtered_count.set(entry["filtered"])
+
+                if archive_enabled:
+                    # The archive is optional, so failing to write it never
+                    # fails the load
+                    try:
+                        await asyncio.to_thread(
+                            issue_archive.write, headers, repo, entry["df"]
+                        )
+                    except OSError as e:
+                        ui.notification_show(
+                            f"Could not save issues to the archive: {e}", type="warning"
+                        )
 
                 p.set(100, message="Complete!")
 
@@ -389,175 +2275,459 @@ def server(input, output, session):
             return f"Issues without labels filtered out: {count}"
         return ""
 
+    @output
+    @render.text
+    def rate_limit_text():
+        # The budget is shared with other sessions, so refresh it periodically
+        # as well as after every load
+        reactive.invalidate_later(10)
+        issues_data()
+        headers = {}
+        if input.github_token():
+            headers["Authorization"] = f"token {input.github_token()}"
+        resource = "graphql" if input.api_backend() == "GraphQL" else "core"
+        budget = github_scheduler.budget(headers, resource)
+        if budget is None:
+            return ""
+        reset = datetime.fromtimestamp(budget["reset"]).strftime("%H:%M")
+        return (
+            f"GitHub API budget: {max(budget['remaining'], 0)}/{budget['limit']}"
+            f" requests, resets at {reset}"
+        )
+
     @output
     @render.text
     def selected_issue_text():
         return input.selected_issue()
 
-    @output
-    @render.data_frame
-    def issues_table_main():
+    # The tables are paged on the server: the frames stay here and only the
+    # visible window is formatted and sent to the browser
+    @reactive.calc
+    def table_views():
+        if search_results() is None:
+            return None
+        matches = with_any_label(search_results(), input.table_labels())
+        in_main = pl.col("Row") < main_count()
+        return [
+            matches.filter(part)
+            .drop("Row")
+            .sort(input.table_sort(), descending=input.table_sort_desc(), nulls_last=True)
+            for part in (in_main, ~in_main)
+        ]
+
+    @reactive.calc
+    def search_index():
+        # Built once per load; searches then only touch the index
         if issues_data() is None:
             return None
-        df = issues_data()
-        main_count = math.floor(len(df) * 0.8)
-        # Create a copy of the DataFrame to modify
-        df_copy = df.head(main_count).to_pandas()
+        return SearchIndex.from_frame(issues_data())
 
-        # Convert the 'Number' column to HTML links
-        repo = input.repo()
-        df_copy["Number"] = df_copy["Number"].apply(
-            lambda x: ui.HTML(f'<a href="https://github.com/{repo}/issues/{x}" target="_blank">{x}</a>')
-        )
+    @reactive.calc
+    def search_results():
+        if search_index() is None:
+            return None
+        with metrics.span("search"):
+            return search_issues(issues_data(), search_index(), input.table_filter())
 
-        # Format the 'Labels' column as colored tags
-        df_copy["Labels"] = df_copy["Labels"].apply(
-            lambda labels: ui.HTML(''.join([
-                f'<span class="label-tag" style="background-color: {get_label_color(label)};">{label}</span>'
-                for label in labels.split(", ")
-            ]))
-        )
+    @reactive.effect
+    def update_label_facets():
+        # Label choices show how many of the search results have each label
+        facets = {}
+        if search_results() is not None:
+            facets = {
+                label: f"{label} ({count})"
+                for label, count in label_facets(search_results()).iter_rows()
+            }
+        with reactive.isolate():
+            selected = list(input.table_labels())
+        for label in selected:
+            facets.setdefault(label, f"{label} (0)")
+        ui.update_selectize("table_labels", choices=facets, selected=selected)
 
-        df_copy["Body"] = df_copy["Body"].apply(truncate_text)
+    @reactive.effect
+    @reactive.event(
+        issues_data, input.table_filter, input.table_labels, input.table_sort,
+        input.table_sort_desc, input.table_page_size,
+    )
+    def reset_table_pages():
+        ui.update_numeric("main_page", value=1)
+        ui.update_numeric("secondary_page", value=1)
+
+    def table_page(view, page):
+        return page_window(view, page, int(input.table_page_size()))
+
+    @reactive.calc
+    def main_page():
+        if table_views() is None:
+            return None
+        return table_page(table_views()[0], input.main_page())
+
+    @reactive.calc
+    def secondary_page():
+        if table_views() is None:
+            return None
+        return table_page(table_views()[1], input.secondary_page())
 
-        return render.DataTable(df_copy, selection_mode="row")
+    def page_info(view, window_page):
+        _, page, page_count = window_page
+        return f"Page {page} of {page_count} ({len(view)} issues)"
+
+    @output
+    @render.text
+    def main_page_info():
+        if main_page() is None:
+            return ""
+        return page_info(table_views()[0], main_page())
+
+    @output
+    @render.text
+    def secondary_page_info():
+        if secondary_page() is None:
+            return ""
+        return page_info(table_views()[1], secondary_page())
 
     @output
     @render.data_frame
+    @metrics.measure("table_render_main")
+    def issues_table_main():
+        if main_page() is None:
+            return None
+        window, _, _ = main_page()
+        return render.DataTable(
+            display_records(window, loaded_repo()), selection_mode="row"
+        )
+
+    @output
+    @render.data_frame
+    @metrics.measure("table_render_secondary")
     def issues_table_secondary():
+        if secondary_page() is None:
+            return None
+        window, _, _ = secondary_page()
+        return render.DataTable(
+            display_records(window, loaded_repo()),
+            selection_mode="row",
+            styles={"class": "clickable-row"},
+        )
+
+    @reactive.calc
+    def main_count():
+        # The first 80% of the loaded issues are the main set, the rest the holdout
+        return math.floor(len(issues_data()) * 0.8)
+
+    @reactive.calc
+    def main_issues():
         if issues_data() is None:
             return None
-        df = issues_data()
-        main_count = math.floor(len(df) * 0.8)
-        df_copy = df.tail(len(df) - main_count).to_pandas()
+        return issues_data().head(main_count())
 
-        # Convert the 'Number' column to HTML links
-        repo = input.repo()
-        df_copy["Number"] = df_copy["Number"].apply(
-            lambda x: ui.HTML(f'<a href="https://github.com/{repo}/issues/{x}" target="_blank">{x}</a>')
-        )
+    @reactive.calc
+    def holdout_issues():
+        if issues_data() is None:
+            return None
+        return issues_data().slice(main_count())
 
-        # Format the 'Labels' column as colored tags
-        df_copy["Labels"] = df_copy["Labels"].apply(
-            lambda labels: ui.HTML(''.join([
-                f'<span class="label-tag" style="background-color: {get_label_color(label)};">{label}</span>'
-                for label in labels.split(", ")
-            ]))
+    @reactive.calc
+    def issues_context():
+        # Rebuilt only when new issues are loaded or the format changes, not
+        # on every chat message
+        if main_issues() is None:
+            return "No issues data available."
+        return format_issues_context(
+            main_issues(), loaded_repo(), input.compact_context()
         )
 
-        df_copy["Body"] = df_copy["Body"].apply(truncate_text)
-
-        return render.DataTable(df_copy, selection_mode="row", styles={ "class": "clickable-row"})
-
-    def format_issues_data():
-        if issues_data() is not None:
-            df = issues_data()
-            repo = input.repo()  # Get the current repository
-            main_count = math.floor(len(df) * 0.8)
-            main_data = df.head(main_count).to_dict(as_series=False)
-            formatted_data = {
-                "repo": repo,
-                "github_issues": [
-                    {
-                        "number": str(num),
-                        "title": main_data["Title"][i],
-                        "created_at": str(main_data["Created At"][i]),
-                        "closed_at": str(main_data["Closed At"][i]),
-                        "labels": main_data["Labels"][i].split(", "),
-                        "body": main_data["Body"][i],  # Include the issue body
-                    }
-                    for i, num in enumerate(main_data["Number"])
-                ],
-            }
-            return json.dumps(formatted_data, indent=2)
-        else:
-            return "No issues data available."
+    @reactive.calc
+    def issues_index():
+        # Built once per load
+        if main_issues() is None:
+            return None
+        return BM25Index.from_frame(main_issues())
 
-    @render.download(filename="github_issues.json")
+    def chat_context(query, fallback=None):
+        """Issues context for the system prompt when answering `query`.
+
+        When no issue is related to `query`, `fallback` is used, or else the
+        context with every issue.
+        """
+        top_k = input.context_top_k()
+        if not top_k or issues_index() is None:
+            return issues_context()
+        # Leave the issue being analyzed out of its own context
+        exclude = {int(number) for number in ISSUE_REFERENCE.findall(query)}
+        related = related_issues(
+            main_issues(),
+            issues_index(),
+            query,
+            top_k,
+            input.context_token_budget() or 0,
+            exclude,
+        )
+        if related.height == 0:
+            return fallback or issues_context()
+        return format_issues_context(related, loaded_repo(), input.compact_context())
+
+    @render.download(
+        filename=lambda: export_filename(input.export_format(), input.export_gzip())
+    )
     def download_json():
         # print("Download function called")  # Debug print
-        yield format_issues_data()
+        if issues_data() is None:
+            yield "No issues data available."
+            return
+        yield from export_issues(
+            main_issues(),
+            loaded_repo(),
+            input.export_format(),
+            input.export_gzip(),
+        )
 
-    @chat.on_user_submit
-    async def send_message():
-        issues_context = format_issues_data()
-        formatted_sys_prompt = input.system_prompt().format(issues_context=issues_context)
+    @reactive.effect
+    @reactive.event(input.refresh_watched)
+    def refresh_watched():
+        issue_prefetcher.refresh_now()
 
-        if input.chat_model() == "AzureOpenAI":
-            messages = chat.messages(format="openai")
+    @reactive.effect
+    @reactive.event(input.refetch_watched)
+    def refetch_watched():
+        issue_prefetcher.refresh_now(force=True)
 
-            # Update the system prompt
-            if messages and messages[0]["role"] == "system":
-                messages[0]["content"] = formatted_sys_prompt
-            else:
-                messages = (
-                    {"role": "system", "content": formatted_sys_prompt},
-                ) + messages
+    @output
+    @render.data_frame
+    def watch_status():
+        reactive.invalidate_later(5)
+        return render.DataTable(issue_prefetcher.status())
+
+    # Archive queries run when the button is pressed, reading only the
+    # partitions and columns they need
+    ARCHIVE_RESULT_ROWS = 1000
+
+    @reactive.calc
+    @reactive.event(input.query_archive)
+    def archive_query():
+        repos = [repo.strip() for repo in input.archive_repos().split(",") if repo.strip()]
+        labels = [
+            label.strip() for label in input.archive_labels().split(",") if label.strip()
+        ]
+        start, end = input.archive_dates()
+        headers = github_headers(input.github_token())
+        lf = issue_archive.scan(headers, repos, start, end, labels)
+        if lf is None:
+            return None
+        summary = (
+            lf.select("Repo", "Labels")
+            .explode("Labels")
+            .group_by("Repo", "Labels")
+            .agg(pl.len().alias("Issues"))
+            .rename({"Labels": "Label"})
+            .sort(["Repo", "Issues"], descending=[False, True])
+        )
+        issues = lf.sort("Created At", descending=True)
+        summary, count, issues = pl.collect_all(
+            [summary, lf.select(pl.len()), issues.head(ARCHIVE_RESULT_ROWS)]
+        )
+        return {"summary": summary, "count": count.item(), "issues": issues}
 
-            # print(messages)
+    @output
+    @render.text
+    def archive_repos_text():
+        input.query_archive()
+        repos = issue_archive.repos(github_headers(input.github_token()))
+        return f"Archived repositories: {', '.join(repos)}" if repos else "The archive is empty."
 
-            response = azure_client.chat.completions.create(
-                model="gpt-4o",
-                messages=messages,
-                stream=True,
-            )
-            await chat.append_message_stream(response)
+    @output
+    @render.text
+    def archive_count_text():
+        result = archive_query()
+        if result is None:
+            return "No archived issues match."
+        shown = min(result["count"], ARCHIVE_RESULT_ROWS)
+        return f"{result['count']} issues match, showing the newest {shown}."
 
-        elif input.chat_model() == "Ollama":
-            messages = chat.messages(format="ollama")
+    @output
+    @render.data_frame
+    def archive_summary():
+        if archive_query() is None:
+            return None
+        return render.DataTable(archive_query()["summary"])
 
-            # Update the system prompt
-            if messages and messages[0]["role"] == "system":
-                messages[0]["content"] = formatted_sys_prompt
-            else:
-                messages = (
-                    {"role": "system", "content": formatted_sys_prompt},
-                ) + messages
+    @output
+    @render.data_frame
+    def archive_results():
+        if archive_query() is None:
+            return None
+        issues = archive_query()["issues"].with_columns(
+            label_text(),
+            pl.col("Body").str.slice(0, 100),
+        )
+        return render.DataTable(issues)
 
-            ollama_client = OllamaClient(host=input.ollama_endpoint())
+    batch_results = reactive.Value(None)
+    # Model answers per selected model, so repeated batch runs only ask for
+    # prompts that changed
+    label_answers = {}
 
-            response = ollama_client.chat(
-                model=input.ollama_model(),
-                messages=messages,
-                stream=True,
+    def chat_model_key():
+        # Only Ollama uses the endpoint and model inputs, so other providers
+        # are shared however those are set
+        chat_model = input.chat_model()
+        if chat_model == "Ollama":
+            return chat_model, input.ollama_endpoint(), input.ollama_model()
+        return chat_model, None, None
+
+    @reactive.effect
+    @reactive.event(input.run_batch_labeling)
+    async def run_batch_labeling():
+        holdout = holdout_issues()
+        if holdout is None or len(holdout) == 0:
+            ui.notification_show(
+                "Load issues before running batch labeling", type="warning"
             )
+            return
+
+        model_key = chat_model_key()
+        system_prompt = input.system_prompt()
+
+        try:
+            provider = get_chat_provider(*model_key)
+        except Exception as e:
+            ui.notification_show(f"Error creating chat model: {str(e)}", type="error")
+            return
+        use_response_cache = input.use_response_cache()
+        model_calls = 0
+
+        async def complete(system, prompt):
+            nonlocal model_calls
+            if use_response_cache:
+                key = response_cache.key(
+                    provider, system, [{"role": "user", "content": prompt}]
+                )
+                answer = await asyncio.to_thread(response_cache.get, key)
+                if answer is not None:
+                    return answer
+            model_calls += 1
+            answer = await provider.complete(system, prompt)
+            if use_response_cache:
+                await asyncio.to_thread(response_cache.put, key, answer)
+            return answer
+
+        known_labels = (
+            issues_data()
+            .select(pl.col("Labels").explode().cast(pl.Utf8).unique().drop_nulls())
+            .to_series()
+            .to_list()
+        )
+        rows = list(holdout.iter_rows(named=True))
+        prompts = [label_prompt(row) for row in rows]
+        jobs = [
+            (system_prompt.format(issues_context=chat_context(prompt)), prompt)
+            for prompt in prompts
+        ]
+        cache = label_answers.setdefault(model_key, {})
+
+        with ui.Progress(min=0, max=len(jobs)) as p:
+            p.set(0, message="Labeling issues...", detail=f"0 of {len(jobs)}")
+            done = 0
+
+            def on_done():
+                nonlocal done
+                done += 1
+                p.set(done, detail=f"{done} of {len(jobs)}")
+
+            start = time.perf_counter()
+            try:
+                answers = await label_issues(
+                    jobs, complete, input.batch_concurrency() or 1, cache, on_done
+                )
+            except Exception as e:
+                ui.notification_show(f"Error labeling issues: {str(e)}", type="error")
+                return
+            elapsed = time.perf_counter() - start
+
+        predicted = [parse_labels(answer, known_labels) for answer in answers]
+        actual = [set(row["Labels"]) for row in rows]
+        precision, recall = label_scores(predicted, actual)
+        batch_results.set(
+            {
+                "issues": holdout.select("Number", "Title", label_text()).with_columns(
+                    pl.Series(
+                        "Predicted Labels",
+                        [", ".join(sorted(labels)) for labels in predicted],
+                        dtype=pl.Utf8,
+                    )
+                ),
+                "precision": precision,
+                "recall": recall,
+                "elapsed": elapsed,
+                "cached": len(jobs) - model_calls,
+            }
+        )
+
+    @output
+    @render.text
+    def batch_summary():
+        results = batch_results()
+        if results is None:
+            return ""
+        count = len(results["issues"])
+        elapsed = results["elapsed"]
+        throughput = count / elapsed if elapsed else float("inf")
+        return (
+            f"Labeled {count} issues in {elapsed:.1f}s ({throughput:.2f} issues/s, "
+            f"{results['cached']} answered from cache). "
+            f"Precision: {results['precision']:.2f}, recall: {results['recall']:.2f}"
+        )
+
+    @output
+    @render.data_frame
+    def batch_results_table():
+        if batch_results() is None:
+            return None
+        return render.DataTable(batch_results()["issues"])
 
-            await chat.append_message_stream(response)
-
-        else: # Claude 3.5 Sonnet via Bedrock
-            messages = chat.messages(format="anthropic")
-
-            # Update the system prompt
-            # if messages and messages[0]["role"] == "system":
-            #     messages[0]["content"] = formatted_sys_prompt
-            # else:
-            #     messages = (
-            #         {"role": "system", "content": formatted_sys_prompt},
-            #     ) + messages
-
-            response = bedrock_client.messages.create(
-                model="anthropic.claude-3-5-sonnet-20240620-v1:0",
-                messages=messages,
-                stream=True,
-                system=formatted_sys_prompt,
-                max_tokens=1000,
+    @chat.on_user_submit
+    async def send_message():
+        started = time.perf_counter()
+        # Retrieve for the whole conversation, keeping the last context when
+        # a follow-up matches nothing
+        context = chat_context(retrieval_query(chat.messages()), last_chat_context.get())
+        last_chat_context.set(context)
+        formatted_sys_prompt = input.system_prompt().format(issues_context=context)
+
+        provider = get_chat_provider(*chat_model_key())
+        messages = chat.messages(format=provider.message_format)
+
+        def live_stream():
+            # Cached replays are left out of the model latency spans
+            return measure_stream(
+                provider.stream(formatted_sys_prompt, messages),
+                started,
+                "chat_first_token",
+                "chat_stream_total",
             )
-            # Append the response stream into the chat
-            await chat.append_message_stream(response)
 
-            
+        if input.use_response_cache():
+            key = response_cache.key(provider, formatted_sys_prompt, messages)
+            answer = await asyncio.to_thread(response_cache.get, key)
+            if answer is not None:
+                response = replay_answer(answer)
+            else:
+                response = cache_answer(response_cache, key, live_stream())
+        else:
+            response = live_stream()
+        # Append the response stream into the chat
+        await chat.append_message_stream(response)
 
     @reactive.Effect
     @reactive.event(input.selected_issue)
     def show_issue_modal():
         issue_number = input.selected_issue()
         if issue_number and issues_data() is not None:
-            df = issues_data()
-            issue = df.filter(pl.col("Number") == int(issue_number)).to_pandas()
-            if not issue.empty:
+            issue = find_issue(int(issue_number))
+            if issue is not None:
                 modal_content = ui.modal(
-                    ui.h3(f"Issue #{issue_number}: {issue['Title'].iloc[0]}"),
-                    ui.p(issue["Body"].iloc[0], id="modal_body"),
+                    ui.h3(f"Issue #{issue_number}: {issue['Title']}"),
+                    ui.p(issue["Body"], id="modal_body"),
                     ui.input_action_button("copy_button", "Copy to Clipboard"),
                     title="Issue Details",
                     easy_close=True,
@@ -565,10 +2735,46 @@ def server(input, output, session):
                 )
                 ui.modal_show(modal_content)
 
+    @output
+    @render.data_frame
+    def diagnostics():
+        reactive.invalidate_later(5)
+        return render.DataTable(metrics.summary())
+
+    @output
+    @render.text
+    def startup_report():
+        # Provider imports are added the first time a model is used
+        reactive.invalidate_later(30)
+        return format_startup_report()
+
     @reactive.Effect
     @reactive.event(input.copy_button)
     def copy_to_clipboard():
         ui.notification_show("Text copied to clipboard!", type="message")
 
 
-app = App(app_ui, server)
+def format_startup_report(timings=startup_timings):
+    width = max(len(name) for name in timings)
+    return "\n".join(
+        f"{name:<{width}}  {seconds * 1000:8.1f} ms" for name, seconds in timings.items()
+    )
+
+
+def metrics_endpoint(request):
+    return PlainTextResponse(
+        metrics.prometheus(), media_type="text/plain; version=0.0.4"
+    )
+
+
+shiny_app = App(app_ui, server)
+app = Starlette(
+    routes=[
+        Route("/metrics", metrics_endpoint),
+        Mount("/", app=shiny_app),
+    ]
+)
+issue_prefetcher.start()
+
+startup_timings["app.py total"] = time.perf_counter() - _module_started
+print("Startup timings:\n" + format_startup_report(), file=sys.stderr)
@@ -0,0 +1,328 @@
+"""Benchmark the issue pipeline of app.py against local stand-ins.
+
+A fake GitHub REST server serves synthetic, paginated issues and a stub
+Ollama endpoint streams tokens, so runs are repeatable and need no network
+or credentials. For each size the load -> process -> search -> render ->
+export -> chat-context path is timed with the app's own functions, and the
+results are written to a JSON file that can be compared between runs:
+
+    python bench.py --sizes 100,1000,10000 --output bench_results.json
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+LABELS = ["bug", "docs", "enhancement", "question", "performance", "ui"]
+WORDS = "crash error slow page table label token issue chart export filter load".split()
+
+
+class FakeAPIHandler(BaseHTTPRequestHandler):
+    """GitHub's issue listing plus Ollama's chat endpoint, from synthetic data.
+
+    `/repos/<owner>/<count>/issues` lists `count` issues, newest first, with
+    Link, ETag and rate limit headers like the real API. `/api/chat` answers
+    like Ollama: token by token as NDJSON, or as one JSON object when the
+    request sets `"stream": false`.
+    """
+
+    label_ratio = 0.5
+    body_size = 500
+    latency = 0.0
+    tokens = 50
+    token_delay = 0.0
+
+    def log_message(self, *args):
+        pass
+
+    @classmethod
+    def issue(cls, count, i):
+        rng = random.Random(i)
+        number = count - i
+        words = " ".join(rng.choice(WORDS) for _ in range(cls.body_size // 6 + 1))
+        issue = {
+            "number": number,
+            "title": f"Issue {number}: {' '.join(rng.sample(WORDS, 4))}",
+            "body": words[: cls.body_size],
+            "state": "closed",
+            "created_at": f"2024-{i % 12 + 1:02d}-{i % 28 + 1:02d}T10:00:00Z",
+            "closed_at": f"2024-{i % 12 + 1:02d}-{i % 28 + 1:02d}T12:00:00Z",
+            "updated_at": f"2024-{i % 12 + 1:02d}-{i % 28 + 1:02d}T12:00:00Z",
+            "labels": [],
+        }
+        if rng.random() < cls.label_ratio:
+            issue["labels"] = [{"name": name} for name in rng.sample(LABELS, 2)]
+        return issue
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = url.path.strip("/").split("/")
+        if len(parts) != 4 or parts[0] != "repos" or parts[3] != "issues":
+            self.send_error(404)
+            return
+        count = int(parts[2])
+        query = parse_qs(url.query)
+        page = int(query.get("page", ["1"])[0])
+        per_page = int(query.get("per_page", ["30"])[0])
+        last = max(math.ceil(count / per_page), 1)
+        start = (page - 1) * per_page
+        body = json.dumps(
+            [self.issue(count, i) for i in range(start, min(count, start + per_page))]
+        ).encode()
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        time.sleep(self.latency)
+
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        base = f"http://{self.headers['Host']}{url.path}?per_page={per_page}"
+        links = [f'<{base}&page={last}>; rel="last"']
+        if page < last:
+            links.insert(0, f'<{base}&page={page + 1}>; rel="next"')
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Link", ", ".join(links))
+        self.send_header("X-RateLimit-Limit", "1000000")
+        self.send_header("X-RateLimit-Remaining", "1000000")
+        self.send_header("X-RateLimit-Reset", str(int(time.time()) + 3600))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if not self.path.startswith("/api/chat"):
+            self.send_error(404)
+            return
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        tokens = [self.answer_token(request, i) for i in range(self.tokens)]
+        if not request.get("stream", True):
+            # Like Ollama, a non-streaming request gets one JSON object
+            time.sleep(self.token_delay * len(tokens))
+            body = json.dumps(self.chunk(request["model"], "".join(tokens), done=True))
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body.encode())
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        for token in tokens:
+            time.sleep(self.token_delay)
+            self.write_chunk(self.chunk(request["model"], token, done=False))
+        self.write_chunk(self.chunk(request["model"], "", done=True))
+
+    @staticmethod
+    def answer_token(request, i):
+        # Labeling prompts get an answer naming labels, so it can be parsed
+        if "label" in request["messages"][-1]["content"].lower() and i < 2:
+            return LABELS[i] + ", "
+        return f"token{i} "
+
+    @staticmethod
+    def chunk(model, content, done):
+        chunk = {
+            "model": model,
+            "created_at": "2024-01-01T00:00:00Z",
+            "message": {"role": "assistant", "content": content},
+            "done": done,
+        }
+        if done:
+            chunk["done_reason"] = "stop"
+        return chunk
+
+    def write_chunk(self, chunk):
+        self.wfile.write((json.dumps(chunk) + "\n").encode())
+        self.wfile.flush()
+
+
+def start_server(args):
+    FakeAPIHandler.label_ratio = args.label_ratio
+    FakeAPIHandler.body_size = args.body_size
+    FakeAPIHandler.latency = args.latency / 1000
+    FakeAPIHandler.tokens = args.tokens
+    FakeAPIHandler.token_delay = args.token_delay / 1000
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeAPIHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def timed_runs(func, repeat):
+    """Run `func` `repeat` times; return its last result and the timings."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return result, {
+        "min_s": min(timings),
+        "median_s": statistics.median(timings),
+        "max_s": max(timings),
+    }
+
+
+async def stream_timings(provider, system, question):
+    start = time.perf_counter()
+    first = None
+    chunks = 0
+    async for _ in provider.stream(system, [{"role": "user", "content": question}]):
+        if first is None:
+            first = time.perf_counter() - start
+        chunks += 1
+    return {"first_token_s": first, "total_s": time.perf_counter() - start, "chunks": chunks}
+
+
+def bench_size(app, size, args, base_url):
+    """Time every stage of the pipeline for a load of `size` issues."""
+    # Enough synthetic issues that `size` of them are labeled
+    total = math.ceil(size / args.label_ratio * 1.2) + 100
+    repo = f"bench/{total}"
+    headers = app.github_headers()
+    results = {"issues_served": total}
+
+    def load():
+        # Each run starts from an empty page cache so pages are really fetched
+        app.page_cache.directory = tempfile.mkdtemp(dir=args.cache_dir)
+        return app.load_repo_entry(repo, "2024-01-01", size, headers)
+
+    entry, results["load"] = timed_runs(load, args.repeat)
+    # Loading again revalidates every page by ETag against the last run's cache
+    _, results["load_revalidated"] = timed_runs(
+        lambda: app.load_repo_entry(repo, "2024-01-01", size, headers), args.repeat
+    )
+    df = entry["df"]
+    results["issues_loaded"] = df.height
+
+    def process():
+        main_count = math.floor(len(df) * 0.8)
+        main, holdout = df.head(main_count), df.tail(len(df) - main_count)
+        search_index = app.SearchIndex.from_frame(df)
+        return main, holdout, search_index, app.BM25Index.from_frame(main)
+
+    (main, holdout, search_index, index), results["process"] = timed_runs(
+        process, args.repeat
+    )
+
+    def search():
+        matches = app.search_issues(df, search_index, args.filter)
+        app.label_facets(matches)
+        return matches.filter(matches["Row"] < len(main)).drop("Row")
+
+    view, results["search"] = timed_runs(search, args.repeat)
+    results["search"]["matches"] = view.height
+
+    def render():
+        window, _, _ = app.page_window(view, 1, args.page_size)
+        secondary, _, _ = app.page_window(holdout, 1, args.page_size)
+        return app.display_records(window, repo), app.display_records(secondary, repo)
+
+    _, results["render"] = timed_runs(render, args.repeat)
+
+    results["export"] = {}
+    for export_format in app.EXPORT_FORMATS:
+        for compress in (False, True):
+            name = f"{export_format}{' gzip' if compress else ''}"
+
+            def export():
+                return sum(
+                    len(chunk if isinstance(chunk, bytes) else chunk.encode())
+                    for chunk in app.export_issues(main, repo, export_format, compress)
+                )
+
+            size_bytes, timings = timed_runs(export, args.repeat)
+            results["export"][name] = {**timings, "bytes": size_bytes}
+
+    def full_context():
+        return app.format_issues_context(main, repo)
+
+    def related_context():
+        related = app.related_issues(
+            main, index, args.query, args.top_k, args.token_budget
+        )
+        return app.format_issues_context(related, repo)
+
+    context, results["context_full"] = timed_runs(full_context, args.repeat)
+    results["context_full"]["chars"] = len(context)
+    context, results["context_related"] = timed_runs(related_context, args.repeat)
+    results["context_related"]["chars"] = len(context)
+
+    provider = app.OllamaProvider(base_url, "bench")
+    results["chat_stream"] = asyncio.run(
+        stream_timings(provider, f"Use:\n{context}", args.query)
+    )
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="100,1000,10000")
+    parser.add_argument("--label-ratio", type=float, default=0.5)
+    parser.add_argument("--body-size", type=int, default=500, help="characters per body")
+    parser.add_argument("--latency", type=float, default=20, help="ms per page")
+    parser.add_argument("--tokens", type=int, default=50, help="tokens per chat answer")
+    parser.add_argument("--token-delay", type=float, default=5, help="ms per token")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--top-k", type=int, default=20)
+    parser.add_argument("--token-budget", type=int, default=4000)
+    parser.add_argument("--filter", default="crash*", help="table search query")
+    parser.add_argument("--query", default="slow export crash", help="chat question")
+    parser.add_argument("--output", default="bench_results.json")
+    args = parser.parse_args(argv)
+    args.label_ratio = min(max(args.label_ratio, 0.01), 1.0)
+
+    server, base_url = start_server(args)
+    args.cache_dir = tempfile.mkdtemp(prefix="bench-cache-")
+    # The app reads its endpoints and cache locations at import time
+    os.environ["GITHUB_API_URL"] = base_url
+    os.environ["GITHUB_ISSUES_CACHE_DIR"] = args.cache_dir
+    os.environ["WATCHED_REPOS"] = ""
+    import app
+
+    results = {}
+    try:
+        for size in [int(size) for size in args.sizes.split(",")]:
+            print(f"Benchmarking {size} issues...", file=sys.stderr)
+            results[str(size)] = bench_size(app, size, args, base_url)
+            load = results[str(size)]["load"]["median_s"]
+            print(f"  load {load * 1000:.1f} ms (median)", file=sys.stderr)
+    finally:
+        server.shutdown()
+        shutil.rmtree(args.cache_dir, ignore_errors=True)
+
+    report = {
+        "created": datetime.now(timezone.utc).isoformat(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "config": {
+            key: value for key, value in vars(args).items() if key != "cache_dir"
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
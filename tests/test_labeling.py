@@ -0,0 +1,114 @@
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# Keep the app's caches out of the working tree and the prefetcher idle
+os.environ["GITHUB_ISSUES_CACHE_DIR"] = tempfile.mkdtemp(prefix="issues-test-")
+os.environ["WATCHED_REPOS"] = ""
+
+import app  # noqa: E402
+import bench  # noqa: E402
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_parse_labels_keeps_known_labels_in_their_spelling():
+    known = ["bug", "Docs", "good first issue"]
+    answer = "**Bug**, `docs`.\n- good first issue\nwontfix"
+    assert app.parse_labels(answer, known) == {"bug", "Docs", "good first issue"}
+
+
+def test_parse_labels_of_an_unrelated_answer_is_empty():
+    assert app.parse_labels("I cannot tell.", ["bug"]) == set()
+
+
+def test_label_scores_are_micro_averaged():
+    predicted = [{"bug", "docs"}, {"ui"}, set()]
+    actual = [{"bug"}, {"ui", "docs"}, {"bug"}]
+    precision, recall = app.label_scores(predicted, actual)
+    assert precision == 2 / 3
+    assert recall == 2 / 4
+
+
+def test_label_scores_without_labels_are_zero():
+    assert app.label_scores([set()], [set()]) == (0.0, 0.0)
+
+
+def test_label_issues_sends_identical_jobs_once_and_keeps_order():
+    calls = []
+
+    async def complete(system, prompt):
+        calls.append(prompt)
+        await asyncio.sleep(0.01)
+        return prompt.upper()
+
+    jobs = [("s", "a"), ("s", "b"), ("s", "a"), ("s", "a")]
+    done = []
+    answers = run(app.label_issues(jobs, complete, on_done=lambda: done.append(1)))
+    assert answers == ["A", "B", "A", "A"]
+    assert sorted(calls) == ["a", "b"]
+    assert len(done) == len(jobs)
+
+
+def test_label_issues_respects_the_concurrency_limit():
+    active = 0
+    peak = 0
+
+    async def complete(system, prompt):
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        await asyncio.sleep(0.01)
+        active -= 1
+        return prompt
+
+    jobs = [("s", str(i)) for i in range(12)]
+    answers = run(app.label_issues(jobs, complete, concurrency=3))
+    assert answers == [str(i) for i in range(12)]
+    assert peak == 3
+
+
+def test_label_issues_answers_cached_jobs_without_calling_the_model():
+    calls = []
+
+    async def complete(system, prompt):
+        calls.append(prompt)
+        return "fresh"
+
+    cache = {("s", "a"): "cached"}
+    answers = run(app.label_issues([("s", "a"), ("s", "b")], complete, cache=cache))
+    assert answers == ["cached", "fresh"]
+    assert calls == ["b"]
+    assert cache[("s", "b")] == "fresh"
+
+
+def test_batch_labeling_against_a_stub_ollama_server():
+    server, url = bench.start_server(
+        argparse.Namespace(
+            label_ratio=1.0, body_size=50, latency=0, tokens=4, token_delay=0
+        )
+    )
+    try:
+        provider = app.OllamaProvider(url, "stub")
+        issues = [
+            {"Number": n, "Title": f"Issue {n}", "Body": "crash", "Labels": ["bug"]}
+            for n in range(5)
+        ]
+        jobs = [("Label issues.", app.label_prompt(issue)) for issue in issues]
+        answers = run(app.label_issues(jobs, provider.complete, concurrency=2))
+    finally:
+        server.shutdown()
+
+    # The stub names the first two of bench.LABELS in every labeling answer
+    predicted = [app.parse_labels(answer, ["bug", "docs", "ui"]) for answer in answers]
+    assert predicted == [{"bug", "docs"}] * len(issues)
+    precision, recall = app.label_scores(
+        predicted, [set(issue["Labels"]) for issue in issues]
+    )
+    assert (precision, recall) == (0.5, 1.0)